@@ -21,13 +21,13 @@ class Model(BaseEstimator, RegressorMixin):
     Internal Working:
     -----------------
     1. Setup: Initializes Ridge regression as the base regressor and XGBoost for modeling residuals.
-    2. Fit:
+    2. Fit: Optionally receives the row indices of the fold, so the data is sliced only once inside the model.
       a. Train Linear Regression on the original series.
       b. Calculate residuals using predictions from the linear regression.
       c. Train XGBoost on these residuals.
     3. Predict:
       a. Predict using the Ridge regression.
-      b. Predict the residuals using XGBoost.
+      b. Predict the residuals using XGBoost, optionally from an already built DMatrix shared between the folds.
       c. The final prediction is the sum of the above two predictions.
 
     Returns:
@@ -39,24 +39,50 @@ class Model(BaseEstimator, RegressorMixin):
         self.regressor_residuals_xgb = xgb.XGBRegressor(**xgb_params) if xgb_params else xgb.XGBRegressor(
             objective='reg:squarederror', random_state=7)
 
-    def fit(self, X, y):
-        self.X_train = X.copy()
+    def fit(self, X, y, idx=None):
+        # Index the rows of the fold once and reuse the same slice for both regressors
+        X_train = KFoldValidator.slicing(X, idx) if idx is not None else X
+        y_train = KFoldValidator.slicing(y, idx) if idx is not None else y
+
+        # Keep only the column names, so the training slice is not saved with the model
+        self.feature_names = getattr(X_train, 'columns', None)
 
         # 1. Train Linear Regression on original series
-        self.regressor_original.fit(self.X_train, y)
-        y_pred_original = self.regressor_original.predict(self.X_train)
+        self.regressor_original.fit(X_train, y_train)
+        y_pred_original = self.regressor_original.predict(X_train)
 
         # 2. Train XGBoost on residuals
-        residuals_xgb = y - y_pred_original
-        self.regressor_residuals_xgb.fit(self.X_train, residuals_xgb)
+        residuals_xgb = y_train - y_pred_original
+        self.regressor_residuals_xgb.fit(X_train, residuals_xgb)
 
         return self
 
-    def predict(self, X_test):
+    def predict(self, X_test, idx=None, dtest=None):
+        if idx is not None:
+            X_test = KFoldValidator.slicing(X_test, idx)
         y_pred_original = self.regressor_original.predict(X_test)
-        y_pred_xgb = self.regressor_residuals_xgb.predict(X_test)
+        if dtest is not None:
+            # Reuse the DMatrix already built for X_test instead of converting it again
+            y_pred_xgb = self.regressor_residuals_xgb.get_booster().predict(dtest)
+        else:
+            y_pred_xgb = self.regressor_residuals_xgb.predict(X_test)
         return y_pred_original + y_pred_xgb
 
+    def build_dmatrix(self, X_test):
+        """
+        Build a DMatrix for X_test with the data settings of the XGBoost regressor, to be shared between the folds.
+
+        Parameters:
+        - X_test : np.array or pd.DataFrame
+            Test features.
+
+        Returns:
+        - xgb.DMatrix: The DMatrix to be passed as dtest to predict.
+        """
+        regressor = self.regressor_residuals_xgb
+        return xgb.DMatrix(X_test, missing=regressor.missing, enable_categorical=regressor.enable_categorical,
+                           nthread=regressor.n_jobs)
+
 
 def wmape(actual, forecast):
     """
@@ -106,11 +132,12 @@ def validate_and_predict(X_train, y_train, X_test, y_divide, model, use_pickle,
     -----------------
     1. Check for Existing Pickle: If `use_pickle` is True, it checks for an existing pickle file and loads the model and predictions from it.
     2. Model Validation:
-      a. Validates the model using KFoldValidator.
+      a. Validates the model using KFoldValidator, saving the fold models in a new run directory inside 'model_w{w}_folds'.
       b. Generates scores based on the validation.
       c. Predicts on the test set.
     3. Save to Pickle:
       a. If `use_pickle` is False, it saves the model, scores, and predictions to a pickle file for later use.
+      b. Removes the fold models of the previous runs, which the new pickle file no longer uses.
     4. Feature Importance (optional):
       a. If `print_top_features` is True, it prints the most important features from the Ridge regression and XGBoost models.
 
@@ -127,19 +154,20 @@ def validate_and_predict(X_train, y_train, X_test, y_divide, model, use_pickle,
 
     # Execute model
     val = KFoldValidator(model, n_splits=10, seed=7, k_fold_type=MultilabelStratifiedKFold,
-                         score_type=[wmape, mean_absolute_error], params=params)
+                         score_type=[wmape, mean_absolute_error], params=params, model_dir=f'model_w{w}_folds')
     score = val.validate(X_train, y_train, y_divide)
     preds = val.predict_avg(X_test)
 
     # Save model to a pickle file
     with open(f'model_w{w}.pkl', 'wb') as f:
         pickle.dump((val, score, preds), f)
+    val.clean_model_dir()
 
     def print_top_features_ridge(n=50):
         """Print the most relevant coefficients of the Ridge model."""
-        model_instance = val.models[0]
+        model_instance = val.get_model(0)
         coef = model_instance.regressor_original.coef_
-        feature_names = model_instance.X_train.columns
+        feature_names = model_instance.feature_names
         sorted_indices = np.argsort(np.abs(coef))[::-1]
 
         print(f"\nTop {n} features for {w} Linear:")
@@ -149,7 +177,7 @@ def validate_and_predict(X_train, y_train, X_test, y_divide, model, use_pickle,
 
     def print_top_features_xgb(n=50):
         """Print the top features of the XGBoost model."""
-        model_instance = val.models[0]
+        model_instance = val.get_model(0)
         importance_dict = model_instance.regressor_residuals_xgb.get_booster().get_score(importance_type='weight')
         sorted_importances = sorted(importance_dict.items(), key=lambda item: item[1], reverse=True)
 
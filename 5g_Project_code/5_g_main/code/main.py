@@ -55,7 +55,8 @@ param_w1 = {
         'subsample': 0.8908677567703485,
         'objective': 'reg:squarederror',
         'random_state': 7
-    }
+    },
+    'verbose': 1
 }
 
 param_w5 = {
@@ -63,7 +64,8 @@ param_w5 = {
     'xgb': {
           'objective': 'reg:squarederror',
           'random_state': 7
-    }
+    },
+    'verbose': 1
 }
 
 param_w10 = {
@@ -71,7 +73,8 @@ param_w10 = {
     'xgb': {
         'objective': 'reg:squarederror',
         'random_state': 7
-    }
+    },
+    'verbose': 1
 }
 
 # Training and validation of w1, w5, and w10 models
@@ -80,11 +83,11 @@ val_w5, score_w5, preds_w5 = validate_and_predict(X_train_w5, y_train_w5, X_test
 val_w10, score_w10, preds_w10 = validate_and_predict(X_train_w10, y_train_w10, X_test_w10, y_divide_w10, model, usa_pickle_w10, 10, print_top_features=True, params=param_w10)
 
 # Calculate the final score
-final_score_wmape = KFoldValidator.calculate_final_score(score_w1[0], score_w5[0], score_w10[0])
-final_score_mae = KFoldValidator.calculate_final_score(score_w1[1], score_w5[1], score_w10[1])
+final_score_wmape = KFoldValidator.calculate_final_score(score_w1[0], score_w5[0], score_w10[0], verbose=1)
+final_score_mae = KFoldValidator.calculate_final_score(score_w1[1], score_w5[1], score_w10[1], verbose=1)
 
 # Generating the Submission ------------------------------------------------------------------------------------------------
-submission_df_final = generate_submission(mask_w1, mask_w5, mask_w10, preds_w1, preds_w5, preds_w10, PATH)
+submission_df_final = generate_submission(mask_w1, mask_w5, mask_w10, preds_w1, preds_w5, preds_w10, PATH, verbose=1)
 
 # Check and print null values information
 print("Null values in each column:\n", submission_df_final.isnull().sum())
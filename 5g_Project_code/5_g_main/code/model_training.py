@@ -1,11 +1,104 @@
 import numpy as np
 import pandas as pd
+import joblib
+from joblib import Parallel, delayed
 from sklearn.metrics import accuracy_score
 from sklearn.model_selection import KFold
 import os
+import shutil
+import tempfile
 import time
 import random
 
+# Number of rows in the test set of each objective multiplied by its weight, and the weights normalized by their sum
+_W1, _W5, _W10 = 23189 * 1, 1608 * 5, 1342 * 5
+_WSUM = _W1 + _W5 + _W10
+_R1, _R5, _R10 = _W1 / _WSUM, _W5 / _WSUM, _W10 / _WSUM
+
+
+def _fit_one_fold(train_idx, test_idx, X, y, params, score_type, ModelCls, xgb_n_jobs, model_path=None):
+    """
+    Fit and score a new model on a single fold of the k-fold validation.
+
+    Parameters:
+    - train_idx, test_idx : np.array
+        Indices of the training and validation rows of the fold.
+    - X, y : np.array or pd.DataFrame
+        Complete features and labels.
+    - params : dict
+        Parameters of the model, with the 'ridge' and 'xgb' keys.
+    - score_type : list
+        Scoring metric functions.
+    - ModelCls : class
+        Model class instantiated for the fold.
+    - xgb_n_jobs : int
+        Number of threads of the XGBoost regressor, used only when its parameters do not set n_jobs.
+    - model_path : string, optional
+        If given, the fitted model is saved to this file and only its path is returned.
+
+    Returns:
+    - tuple: containing the model returned by fit (or the path where it was saved) and the scores of the fold.
+    """
+    y_test = KFoldValidator.slicing(y, test_idx)
+
+    model = ModelCls(ridge_params=params['ridge'], xgb_params=params['xgb'])
+
+    # Limit the XGBoost threads on the built regressor, so its default parameters are kept
+    xgb_model = getattr(model, 'regressor_residuals_xgb', None)
+    if xgb_model is not None and xgb_model.n_jobs is None:
+        xgb_model.set_params(n_jobs=xgb_n_jobs)
+
+    # Keep what fit returns, so the validator can detect a model that was not fitted correctly
+    fitted_model = model.fit(X, y, train_idx)
+    y_pred = model.predict(X, test_idx)
+
+    score = score_type[0](y_test, y_pred)
+    score1 = score_type[1](y_test, y_pred)
+
+    if model_path is not None and fitted_model is not None:
+        # Save the model from the worker, so it is neither sent back nor kept in memory by the validator
+        joblib.dump(fitted_model, model_path, compress=0, protocol=5)
+        return model_path, (score, score1)
+    return fitted_model, (score, score1)
+
+
+def _load_model(model):
+    """
+    Return the fold model, loading it from disk if only its path was kept.
+
+    Parameters:
+    - model : model or string
+        Fitted model or path of the file where it was saved.
+
+    Returns:
+    - model: The fitted model. When loaded from disk, its NumPy arrays (e.g. the Ridge coefficients) are
+      memory-mapped, while the XGBoost booster is deserialized into memory.
+    """
+    if isinstance(model, str):
+        return joblib.load(model, mmap_mode='r')
+    return model
+
+
+def _load_and_predict(model, X_test, dtest):
+    """
+    Load a fold model if needed and predict the test features.
+
+    Parameters:
+    - model : model or string
+        Fitted model or path of the file where it was saved.
+    - X_test : np.array or pd.DataFrame
+        Test features.
+    - dtest : xgb.DMatrix or None
+        DMatrix already built for X_test, only passed to models that build one.
+
+    Returns:
+    - np.array: Predicted values of the fold model.
+    """
+    model = _load_model(model)
+    if dtest is None:
+        return model.predict(X_test)
+    return model.predict(X_test, dtest=dtest)
+
 
 class KFoldValidator:
     """
@@ -21,11 +114,16 @@ class KFoldValidator:
         Type of k-fold split strategy. Default is KFold.
     - score_type : callable
         Scoring metric function. Default is accuracy_score.
+    - model_dir : string, optional
+        Directory where the fold models are saved, one subdirectory per validation run. If given, only their absolute
+        paths are kept (and pickled) by the validator, and predict_avg loads each fold only while it predicts, so at
+        most as many models as prediction threads are in memory at once. The directories of previous runs are removed
+        by clean_model_dir. Default is None.
 
     Internal Working:
     -----------------
     1. Setup: Configures the basic parameters for k-fold cross-validation.
-    2. Validation: Performs validation using the indices generated by KFold.
+    2. Validation: Performs validation of the folds in parallel using the indices generated by KFold.
     3. Scoring: Calculates the score based on the provided scoring metric.
     4. Average of Scores: Calculates and returns the average of scores.
 
@@ -33,7 +131,8 @@ class KFoldValidator:
     - float: containing the average score after validation.
     """
 
-    def __init__(self, model, n_splits=10, seed=7, k_fold_type=KFold, score_type=accuracy_score, params={}):
+    def __init__(self, model, n_splits=10, seed=7, k_fold_type=KFold, score_type=accuracy_score, params={},
+                 model_dir=None):
         self.model = model
         self.n_splits = n_splits
         self.kf = k_fold_type(n_splits=n_splits, shuffle=True, random_state=seed)
@@ -41,6 +140,10 @@ class KFoldValidator:
         self.seed = seed
         self.score_type = score_type
         self.params = params
+        self._splits = None
+        self._splits_key = None
+        self.verbose = params.get('verbose', 0)
+        self.model_dir = model_dir
 
     def validate(self, X, y, y_divide=None):
         """
@@ -57,48 +160,61 @@ class KFoldValidator:
         Returns:
         - tuple: containing the average of scores for each fold.
         """
-        fold_scores = []
-        self._seed_everything(self.seed)
-
-        for train_index, test_index in self.kf.split(X, y_divide):
-            start_time = time.time()
-            X_train = self.slicing(X, train_index)
-            X_test = self.slicing(X, test_index)
-            y_train = self.slicing(y, train_index)
-            y_test = self.slicing(y, test_index)
-
-            model = self.model(ridge_params=self.params['ridge'], xgb_params=self.params['xgb'])
-
-            self.models.append(model.fit(X_train, y_train))
-            y_pred = model.predict(X_test)
-
-            score = self.score_type[0](y_test, y_pred)
-            score1 = self.score_type[1](y_test, y_pred)
-            fold_scores.append((score, score1))
-
-            end_time = time.time()
-            elapsed_time = end_time - start_time
-            print(f"Fold score: {score:.2f}, {score1:.2f}, Time elapsed: {elapsed_time:.2f} seconds")
-
-        print("Scores per fold:", fold_scores)
-
-        # Separando os scores
-        score_0 = [s[0] for s in fold_scores]
-        score_1 = [s[1] for s in fold_scores]
+        # Split the cores between the folds running in parallel, so XGBoost does not oversubscribe them
+        xgb_n_jobs = max(1, os.cpu_count() // self.n_splits)
+
+        # Materialize the fold indices once, so repeated validations reuse the splits. The splits only depend on
+        # the number of samples and on y_divide, so the cache is keyed on both
+        splits_key = (len(X), joblib.hash(y_divide))
+        if self._splits is None or self._splits_key != splits_key:
+            self._splits = [(train_index.astype(np.int32), test_index.astype(np.int32))
+                            for train_index, test_index in self.kf.split(X, y_divide)]
+            self._splits_key = splits_key
+
+        # Save each validation run in its own directory with absolute paths, so a pickled validator can be loaded
+        # from any working directory and a new run never overwrites the files an older pickle points to
+        model_paths = [None] * len(self._splits)
+        if self.model_dir is not None:
+            os.makedirs(self.model_dir, exist_ok=True)
+            run_dir = tempfile.mkdtemp(prefix='run_', dir=os.path.abspath(self.model_dir))
+            model_paths = [os.path.join(run_dir, f'fold_{i}.joblib') for i in range(len(self._splits))]
+
+        start_time = time.time()
+        results = Parallel(n_jobs=-1, backend='loky', batch_size=1)(
+            delayed(_fit_one_fold)(train_index, test_index, X, y, self.params, self.score_type, self.model,
+                                   xgb_n_jobs, model_path)
+            for (train_index, test_index), model_path in zip(self._splits, model_paths))
+
+        fold_scores = np.empty((len(results), 2), dtype=np.float64)
+        for i, (model, (score, score1)) in enumerate(results):
+            self.models.append(model)
+            fold_scores[i] = score, score1
+            if self.verbose:
+                print(f"Fold score: {score:.2f}, {score1:.2f}")
+
+        if any(model is None for model in self.models):
+            raise ValueError("Um dos modelos não foi inicializado corretamente.")
 
         # Calculando a média
-        mean_score_0 = np.mean(score_0)
-        mean_score_1 = np.mean(score_1)
+        mean_score_0, mean_score_1 = fold_scores.mean(axis=0)
 
-        print("Mean score 0:", mean_score_0)
-        print("Mean score 1:", mean_score_1)
+        if self.verbose:
+            elapsed_time = time.time() - start_time
+            print(f"Time elapsed: {elapsed_time:.2f} seconds")
+            print("Scores per fold:", fold_scores)
+            print("Mean score 0:", mean_score_0)
+            print("Mean score 1:", mean_score_1)
 
         return mean_score_0, mean_score_1
 
     @staticmethod
     def _seed_everything(seed):
         """
-        Fix all seeds for reproducibility.
+        Fix the global seeds for reproducibility, meant to be called once at the start of the pipeline.
+
+        The folds and the regressors are seeded through their own random_state, so validate and predict_avg
+        do not reseed the global generators. PYTHONHASHSEED is only read at interpreter startup, so it has
+        to be set in the environment before launching Python.
 
         Parameters:
         - seed : int
@@ -106,7 +222,6 @@ class KFoldValidator:
         """
         random.seed(seed)
         np.random.seed(seed)
-        os.environ['PYTHONHASHSEED'] = str(seed)
 
     @staticmethod
     def slicing(data, indices, reset_index=False):
@@ -132,6 +247,34 @@ class KFoldValidator:
         else:
             return data[indices]
 
+    def get_model(self, i):
+        """
+        Get the model of a fold, loading it from disk if it was saved in model_dir.
+
+        Parameters:
+        - i : int
+            Position of the fold model.
+
+        Returns:
+        - model: The fitted model of the fold.
+        """
+        return _load_model(self.models[i])
+
+    def clean_model_dir(self):
+        """
+        Remove the run directories of model_dir that are not used by the fold models of this validator.
+
+        Meant to be called once the validator is saved, so the folds of previous runs do not accumulate on disk.
+        """
+        if self.model_dir is None or not os.path.isdir(self.model_dir):
+            return
+        model_dir = os.path.abspath(self.model_dir)
+        used_dirs = {os.path.dirname(model) for model in self.models if isinstance(model, str)}
+        for name in os.listdir(model_dir):
+            run_dir = os.path.join(model_dir, name)
+            if name.startswith('run_') and os.path.isdir(run_dir) and run_dir not in used_dirs:
+                shutil.rmtree(run_dir)
+
     def predict_avg(self, X_test):
         """
         Predict using the average of all models from k-fold validation.
@@ -143,17 +286,30 @@ class KFoldValidator:
         Returns:
         - np.array: Predicted values.
         """
-        self._seed_everything(self.seed)
-        predictions = np.zeros(X_test.shape[0])
-        for model in self.models:
-            if model is None:
-                raise ValueError("Um dos modelos não foi inicializado corretamente.")
-            else:
-                predictions += model.predict(X_test)
-        return predictions / self.n_splits
+        predictions = np.zeros(X_test.shape[0], dtype=np.float32)
+        if not self.models:
+            return predictions
+
+        # Models that build an XGBoost DMatrix get it once and share it between the boosters of all the folds.
+        # The class is checked first, and the first fold is loaded only once when its regressor settings are needed
+        models = self.models
+        dtest = None
+        if getattr(self.model, 'build_dmatrix', None) is not None:
+            first_model = self.get_model(0)
+            dtest = first_model.build_dmatrix(X_test)
+            models = [first_model] + self.models[1:]
+
+        # The predictions of the folds are independent and release the GIL, so threads avoid copying X_test
+        fold_preds = Parallel(n_jobs=-1, prefer='threads')(
+            delayed(_load_and_predict)(model, X_test, dtest) for model in models)
+
+        # Parallel returns the folds in input order, so summing them sequentially keeps the float32 result reproducible
+        for preds in fold_preds:
+            np.add(predictions, preds, out=predictions, casting='unsafe')
+        return predictions * (1.0 / len(self.models))
 
     @staticmethod
-    def calculate_final_score(scores_w1, scores_w5, scores_w10):
+    def calculate_final_score(scores_w1, scores_w5, scores_w10, verbose=0):
         """
         Calculates the final score based on multiple scores and associated weights.
 
@@ -164,34 +320,30 @@ class KFoldValidator:
             Score associated with weight w5. (Objective B)
         - scores_w10 : float
             Score associated with weight w10. (Objective C)
+        - verbose : int, optional
+            If non-zero, prints the weights and the final score. Default is 0.
 
         Internal Working:
         -----------------
-        1. Weight Calculation: Multiplies constants 23189, 1608, and 1342 (Number of rows in the test set) by their respective weights 1, 5, and 5.
-        2. Final Score Calculation: Calculates the weighted average of the scores using the calculated weights.
-        3. Print Results: Displays the weights and the final score.
+        1. Weights: Uses the module constants 23189, 1608, and 1342 (Number of rows in the test set) multiplied by their respective weights 1, 5, and 5, already normalized by their sum.
+        2. Final Score Calculation: Calculates the weighted average of the scores using the normalized weights.
+        3. Print Results: Displays the weights and the final score when verbose is set.
 
         Returns:
         - float: The calculated final score.
         """
-        # Calculate the weights
-        weight_w1 = 23189 * 1
-        weight_w5 = 1608 * 5
-        weight_w10 = 1342 * 5
-
         # Calculate the final score
-        final_score = (scores_w1 * weight_w1 + scores_w5 * weight_w5 + scores_w10 * weight_w10) / (
-                weight_w1 + weight_w5 + weight_w10)
+        final_score = scores_w1 * _R1 + scores_w5 * _R5 + scores_w10 * _R10
 
         # Print the results
-        print(
-            f'weight_w1: {weight_w1}, weight_w5: {weight_w5}, weight_w10: {weight_w10}, final_score: {final_score:.5f}')
-        print(f'w1: {scores_w1:.5f}, w5: {scores_w5:.5f}, w10: {scores_w10:.5f}, final_score: {final_score:.5f}')
+        if verbose:
+            print(f'weight_w1: {_W1}, weight_w5: {_W5}, weight_w10: {_W10}, '
+                  f'w1: {scores_w1:.5f}, w5: {scores_w5:.5f}, w10: {scores_w10:.5f}, final_score: {final_score:.5f}')
 
         return final_score
 
 
-def generate_submission(mask_w1, mask_w5, mask_w10, preds_iter_w1, preds_iter_w5, preds_iter_w10, path):
+def generate_submission(mask_w1, mask_w5, mask_w10, preds_iter_w1, preds_iter_w5, preds_iter_w10, path, verbose=0):
     """
     Generates a submission file using given predictions and masks.
 
@@ -202,69 +354,66 @@ def generate_submission(mask_w1, mask_w5, mask_w10, preds_iter_w1, preds_iter_w5
         Predicted values corresponding to the masks.
     - path : string
         Directory path to the sample submission file.
+    - verbose : int, optional
+        If non-zero, prints the shapes and the first rows of the intermediate data. Default is 0.
 
     Internal Working:
     -----------------
-    1. Data Loading: Loads the 'data_pivot_load.csv' file and prepares it for processing.
-    2. Sorting and Categorizing: Sorts the data based on the 'BS' and 'Time' columns and categorizes 'BS' and 'RUType' columns.
-    3. Data Splitting: Isolates the test data where the 'Energy' value is -1.
-    4. Printing Data Shapes: Prints the shape of the data filtered using masks.
-    5. Prediction DataFrames: Creates three separate DataFrames for predictions corresponding to each mask.
-    6. Assigning Predictions: Depending on the 'w' value, assigns the relevant predictions to the 'Energy' column.
-    7. Preparing Final Submission:
-      a. Reads the sample submission file.
+    1. Data Loading: Loads the 'data_pivot_load.csv' file, with 'Time' parsed as datetime and 'BS' and 'RUType' as categories.
+    2. Sorting and Data Splitting: Sorts the data based on the 'BS' and 'Time' columns and isolates the test data where the 'Energy' value is -1.
+    3. Printing Data Shapes: Prints the shape of the data filtered using masks when verbose is set.
+    4. Assigning Predictions: Depending on the 'w' value, selects the relevant predictions for the 'Energy' column in a single vectorized pass.
+    5. Preparing Final Submission:
+      a. Reads the IDs of the sample submission file.
       b. Constructs an 'ID' column in the data.
-      c. Filters out the rows required for submission and selects 'ID' and 'Energy' columns.
+      c. Looks up the 'Energy' of each ID required for submission, keeping the template order.
       d. Writes the final submission DataFrame to 'submission.csv'.
 
     Returns:
     - DataFrame: The final submission DataFrame containing 'ID' and 'Energy' columns.
     """
-    data = pd.read_csv('../data/data_pivot_load.csv')
-    sorted_data = data.copy()
-    sorted_data['Time'] = pd.to_datetime(sorted_data['Time'])
-    sorted_data = sorted_data.sort_values(['BS', 'Time'])
-    sorted_data['BS_cat'] = sorted_data['BS'].astype('category').cat.codes
-    sorted_data['RUType_cat'] = sorted_data['RUType'].astype('category').cat.codes
+    data = pd.read_csv('../data/data_pivot_load.csv', parse_dates=['Time'], dtype={'BS': 'category', 'RUType': 'category'},
+                       cache_dates=True)
+    # The masks and predictions are positional in ('BS', 'Time') order, so do not rely on the order of the file
+    data = data.sort_values(['BS', 'Time'])
 
     # Split the data while respecting the temporal order
-    test_data = sorted_data[sorted_data['Energy'] == -1]
-    submission_data = test_data[['Time', 'BS', 'Energy', 'w', 'RUType_cat']]
+    submission_data = data.loc[data['Energy'].eq(-1), ['Time', 'BS', 'Energy', 'w']].copy()
 
     # Print shapes using masks
-    print(submission_data[mask_w1].shape)
-    print(submission_data[mask_w5].shape)
-    print(submission_data[mask_w10].shape)
-
-    # Create prediction dataframes
-    preds_w1 = pd.DataFrame(preds_iter_w1, index=submission_data.index, columns=['Energy_pred'])
-    preds_w5 = pd.DataFrame(preds_iter_w5, index=submission_data.index, columns=['Energy_pred'])
-    preds_w10 = pd.DataFrame(preds_iter_w10, index=submission_data.index, columns=['Energy_pred'])
+    if verbose:
+        print(submission_data[mask_w1].shape)
+        print(submission_data[mask_w5].shape)
+        print(submission_data[mask_w10].shape)
 
-    # Assign predictions based on the value of 'w'
-    submission_data.loc[mask_w1, 'Energy'] = preds_w1.loc[mask_w1, 'Energy_pred']
-    submission_data.loc[mask_w5, 'Energy'] = preds_w5.loc[mask_w5, 'Energy_pred']
-    submission_data.loc[mask_w10, 'Energy'] = preds_w10.loc[mask_w10, 'Energy_pred']
+    # Assign predictions based on the value of 'w', the masks and predictions follow the row order of the test data
+    conditions = [np.asarray(mask, dtype=bool) for mask in (mask_w1, mask_w5, mask_w10)]
+    choices = [np.asarray(preds).ravel() for preds in (preds_iter_w1, preds_iter_w5, preds_iter_w10)]
+    submission_data['Energy'] = np.select(conditions, choices, default=submission_data['Energy'].to_numpy())
 
     # Print results
-    print(submission_data.shape)
-    print(submission_data[mask_w1].head(10))
-    print(submission_data[mask_w5].head(10))
-    print(submission_data[mask_w10].head(10))
-
-    template_submission = pd.read_csv(f'{path}sample_submission.csv')
-    submission_data['ID'] = submission_data['Time'].astype(str) + '_' + submission_data['BS']
-
-    print(template_submission['ID'].head())
-    print(submission_data['ID'].head())
-
-    # Filter only required IDs and columns for the final submission
-    required_ids = template_submission['ID']
-    final_submission = submission_data[submission_data['ID'].isin(required_ids)][['ID', 'Energy']]
-
-    final_submission.reset_index(drop=True, inplace=True)
-    print(final_submission.head(10))
-    print(final_submission.shape)
+    if verbose:
+        print(submission_data.shape)
+
+    # Only the IDs are used from the template submission
+    required_ids = pd.read_csv(f'{path}sample_submission.csv', usecols=['ID'])['ID']
+    # Build the IDs on fixed-width NumPy strings instead of concatenating Python objects element by element
+    time_str = submission_data['Time'].dt.strftime('%Y-%m-%d %H:%M:%S').to_numpy(dtype='U19')
+    bs_str = submission_data['BS'].to_numpy(dtype=str)
+    submission_data['ID'] = np.char.add(np.char.add(time_str, '_'), bs_str)
+
+    if verbose:
+        print(required_ids.head())
+        print(submission_data['ID'].head())
+
+    # Keep only the required IDs, in the same order as the template submission, with a single hash lookup
+    energy_by_id = pd.Series(submission_data['Energy'].to_numpy(), index=submission_data['ID'].to_numpy())
+    final_submission = pd.DataFrame({'ID': required_ids.to_numpy(),
+                                     'Energy': energy_by_id.reindex(required_ids.to_numpy()).to_numpy()})
+
+    if verbose:
+        print(final_submission.head(10))
+        print(final_submission.shape)
 
     final_submission.to_csv('submission.csv', index=False)
     return final_submission